@@ -1,31 +1,79 @@
-import os, time, datetime, cv2
+import os, time, threading, queue, cv2
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 from pypylon import pylon, genicam
+from capture_common import (configure_opencv, open_triggered_cam, make_run_dir,
+                            put_drop_oldest, stop_writer, draw_overlay,
+                            shrink_for_preview, WriterStats)
+
+QUEUE_LEN  = 64              # frames buffered for the writer thread
+IO_WORKERS = 4               # threads doing the actual file writes
+IO_BATCH   = 32              # writes in flight before the writer waits on them
+FLASH_NS   = 500_000_000     # overlay shown for 0.5 s after each photo
+_mono      = time.monotonic_ns   # integer clock, no float math in the loop
+
+
+def wait_writes(pending):
+    """Wait for submitted (fname, future) writes; log failures instead of raising."""
+    for fname, f in pending:
+        try:
+            f.result()
+        except OSError as e:
+            print(f"[writer] could not write {fname}: {e}")
+    pending.clear()
 
-# ---------- camera open & trigger config ----------
-cam = pylon.InstantCamera(pylon.TlFactory.GetInstance().CreateFirstDevice())
-cam.Open()
-nm = cam.GetNodeMap()
-nm.GetNode("TriggerSelector").SetValue("AcquisitionStart")
-nm.GetNode("TriggerMode").SetValue("On")
-nm.GetNode("TriggerSource").SetValue("Line1")
-nm.GetNode("TriggerActivation").SetValue("RisingEdge")
-try:
-    nm.GetNode("AcquisitionFrameRateEnable").SetValue(False)
-except genicam.GenericException:
-    pass
 
-cam.StartGrabbing(pylon.GrabStrategy_OneByOne)
+def writer_worker(q: queue.Queue, stats: WriterStats):
+    """Thread: PNG-encode queued (filename, frame) pairs; file writes overlap on an I/O pool.
+
+    A failed frame is logged and skipped so the thread keeps draining the queue.
+    """
+    pending = []
+    with ThreadPoolExecutor(IO_WORKERS) as io_pool:
+        while True:
+            item = q.get()
+            if item is None:
+                break
+            fname, frame = item
+            try:
+                t0 = time.monotonic_ns()
+                ok, png = cv2.imencode(".png", frame)
+                if ok:
+                    pending.append((fname, io_pool.submit(Path(fname).write_bytes, png)))
+                    stats.record_write(t0)
+                else:
+                    print(f"[writer] could not encode {fname}")
+            except cv2.error as e:
+                print(f"[writer] could not encode {fname}: {e}")
+            if len(pending) >= IO_BATCH:     # submit many, wait once
+                wait_writes(pending)
+            q.task_done()
+        wait_writes(pending)
+
+
+configure_opencv()
+
+# ---------- camera open & trigger config ----------
+cam = open_triggered_cam(selector="AcquisitionStart")
+cam.StartGrabbing(pylon.GrabStrategy_OneByOne)   # one photo per pulse, none skipped
 
 # ---------- output folder ----------
-stamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-out_dir = os.path.join("output", stamp)
-os.makedirs(out_dir, exist_ok=True)
+out_dir = make_run_dir()
+prefix  = os.fspath(out_dir) + os.sep + "frame_"   # built once, not per frame
+
+# ---------- writer thread ----------
+q = queue.Queue(QUEUE_LEN)
+stats = WriterStats()
+writer = threading.Thread(target=writer_worker, args=(q, stats), daemon=True)
+writer.start()
 
 print("READY  pulse Line1 HIGH to take a photo (press 'q' to quit)")
 cv2.namedWindow("Basler Preview", cv2.WINDOW_NORMAL)
 
 count          = 0
-flash_until_ms = 0           # when to stop drawing the overlay
+flash_until_ns = 0           # when to stop drawing the overlay
+preview        = None        # latest frame at display size, shown between triggers
+disp_buf       = None        # scratch buffer for the overlay, allocated once
 
 try:
     while cam.IsGrabbing():
@@ -34,30 +82,30 @@ try:
         except genicam.TimeoutException:
             continue        # no trigger in last second – keep waiting
 
+        stats.skipped += res.GetNumberOfSkippedImages()
         if res.GrabSucceeded():
             frame = res.Array
             count += 1
 
-            # ---- save frame ----
-            fname = os.path.join(out_dir, f"frame_{count:05d}.png")
-            cv2.imwrite(fname, frame)
+            # ---- hand frame to writer ----
+            fname = f"{prefix}{count:05d}.png"
+            put_drop_oldest(q, (fname, frame), stats)  # full-res frame goes to disk
+            preview = shrink_for_preview(frame)
 
             # ---- set overlay timer ----
-            flash_until_ms = int(time.time()*1000) + 500   # 0.5s flash
+            flash_until_ns = _mono() + FLASH_NS
 
         res.Release()
 
         # ---- show preview ----
-        display = frame.copy() if 'frame' in locals() else None
-        if display is not None:
-            t_now = int(time.time()*1000)
-            if t_now < flash_until_ms:
-                cv2.putText(display, f"PHOTO #{count} saved",
-                            (20, 40), cv2.FONT_HERSHEY_SIMPLEX,
-                            1.0, (255,0,0), 2, cv2.LINE_AA)
-            cv2.imshow("Basler Preview", display)
-
-        if cv2.waitKey(1) & 0xFF == ord('q'):
+        if preview is not None:
+            if _mono() < flash_until_ns:
+                disp_buf = draw_overlay(preview, f"PHOTO #{count} saved", (255,0,0), disp_buf)
+                cv2.imshow("Basler Preview", disp_buf)
+            else:
+                cv2.imshow("Basler Preview", preview)
+
+        if cv2.pollKey() & 0xFF == ord('q'):
             break
 
 except KeyboardInterrupt:
@@ -65,5 +113,7 @@ except KeyboardInterrupt:
 
 cam.StopGrabbing()
 cam.Close()
+stop_writer(q, writer)        # tell writer to finish once the queue drains
 cv2.destroyAllWindows()
+print(f"[writer] {stats.summary()}")
 print(f"Finished  {count} photos saved to {out_dir}")
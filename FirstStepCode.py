@@ -1,11 +1,111 @@
 from pypylon import pylon
 import cv2
 import time
-import json
 import os
+import queue
+import threading
 from datetime import datetime
+from fractions import Fraction
+
+import numpy as np
+import orjson
+
+from capture_common import (configure_opencv, put_drop_oldest, stop_writer,
+                            shrink_for_preview, WriterStats)
+
+try:
+    import av
+except ImportError:  # PyAV not installed: fall back to OpenCV's XVID writer
+    av = None
+
+QUEUE_LEN = 64  # frames buffered between grab loop and video writer
+H264_ENCODERS = ("h264_nvenc", "h264_qsv", "h264_amf", "libx264")  # GPU encoders first
+H264_PIX_FMT = "nv12"  # the one 4:2:0 format all of H264_ENCODERS accept (QSV has no yuv420p)
+PREVIEW_EVERY = 3         # show every 3rd frame (~10 Hz at 30 fps)
+
+
+class TimestampLog:
+    """Parallel growable int64 arrays of frame indices and times (ms), doubled when full."""
+
+    def __init__(self, capacity=1024):
+        self.idx = np.empty(capacity, np.int64)
+        self.ts = np.empty(capacity, np.int64)
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def append(self, frame_index, time_ms):
+        if self.n == len(self.idx):
+            self.idx = np.resize(self.idx, 2 * len(self.idx))
+            self.ts = np.resize(self.ts, 2 * len(self.ts))
+        self.idx[self.n] = frame_index
+        self.ts[self.n] = time_ms
+        self.n += 1
+
+    def save(self, path):
+        np.savez_compressed(path, idx=self.idx[:self.n], ts=self.ts[:self.n])
+
+
+def video_writer_worker(q, video_writer, frame_timestamps, stats):
+    """Thread: encode queued frames and log (frame_index, time_ms) for each one written.
+
+    A frame that fails to encode is logged and skipped so the queue keeps draining.
+    """
+    while True:
+        item = q.get()
+        if item is None:
+            break
+        frame_index, time_ms, image = item
+        try:
+            t0 = time.monotonic_ns()
+            video_writer.write(image)
+            stats.record_write(t0)
+            frame_timestamps.append(frame_index, time_ms)
+        except Exception as e:  # PyAV raises on encode/mux errors
+            print(f"Error writing frame {frame_index}: {e}")
+        q.task_done()
+
+
+def pick_h264_encoder(width, height, fps):
+    """Return the first H.264 encoder PyAV can open on this machine, or None."""
+    if av is None:
+        return None
+    for name in H264_ENCODERS:
+        try:
+            ctx = av.CodecContext.create(name, "w")
+            ctx.width, ctx.height = width & ~1, height & ~1
+            ctx.pix_fmt = H264_PIX_FMT
+            ctx.time_base = 1 / Fraction(fps).limit_denominator(1001)
+            ctx.open()
+            return name
+        except Exception:  # encoder not built in, or no matching GPU/driver
+            continue
+    return None
+
+
+class H264Writer:
+    """cv2.VideoWriter look-alike that encodes through PyAV."""
+
+    def __init__(self, path, codec, fps, width, height):
+        self.container = av.open(path, "w")
+        self.stream = self.container.add_stream(codec, rate=Fraction(fps).limit_denominator(1001))
+        # 4:2:0 needs even dimensions; drop the odd last row/column if any
+        self.stream.width, self.stream.height = width & ~1, height & ~1
+        self.stream.pix_fmt = H264_PIX_FMT
+
+    def write(self, image):
+        image = np.ascontiguousarray(image[:self.stream.height, :self.stream.width])
+        frame = av.VideoFrame.from_ndarray(image, format="gray" if image.ndim == 2 else "bgr24")
+        self.container.mux(self.stream.encode(frame))
+
+    def release(self):
+        self.container.mux(self.stream.encode())  # flush delayed frames
+        self.container.close()
+
 
 def main():
+    configure_opencv()
 
     #PYLON_RT = r"C:\Program Files\Basler\pylon 8\Runtime\win32"
 
@@ -53,15 +153,20 @@ def main():
     width = camera.Width.Value
     height = camera.Height.Value
     print(f"Camera ready. Image size: {width}x{height}")
+    video_codec = pick_h264_encoder(width, height, actual_fps)
+    print(f"Video encoder: {video_codec or 'OpenCV XVID'}")
     print("Press 's' to start recording")
     print("Press 'q' to stop recording and quit")
     
     # Start camera grabbing but don't record yet
     camera.StartGrabbing(pylon.GrabStrategy_LatestImageOnly)
     recording = False
+    grab_count = 0
     frame_count = 0
-    frame_timestamps = []
+    frame_timestamps = TimestampLog()
     video_writer = None
+    write_queue = None
+    writer_thread = None
     start_time_ms = None
     timestamp = None
     start_frame_path = None
@@ -72,9 +177,12 @@ def main():
         grabResult = camera.RetrieveResult(5000, pylon.TimeoutHandling_ThrowException)
         if grabResult.GrabSucceeded():
             image = grabResult.Array
-            cv2.imshow("Camera Feed", image)
+            grab_count += 1
+            if grab_count % PREVIEW_EVERY == 0:
+                cv2.imshow("Camera Feed", shrink_for_preview(image))
             
-            key = cv2.waitKey(1) & 0xFF
+            # pollKey returns at once and still pumps HighGUI events
+            key = cv2.pollKey() & 0xFF
             if key == ord('s') and not recording:
                 # Create new folder with timestamp
                 timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -84,12 +192,22 @@ def main():
 
                 # Start recording
                 recording = True
-                video_filename = os.path.join(output_folder, "output.avi")
-                fourcc = cv2.VideoWriter_fourcc(*'XVID')
-                video_writer = cv2.VideoWriter(video_filename, fourcc, actual_fps, (width, height))
+                if video_codec is not None:
+                    video_filename = os.path.join(output_folder, "output.mp4")
+                    video_writer = H264Writer(video_filename, video_codec, actual_fps, width, height)
+                else:
+                    video_filename = os.path.join(output_folder, "output.avi")
+                    fourcc = cv2.VideoWriter_fourcc(*'XVID')
+                    video_writer = cv2.VideoWriter(video_filename, fourcc, actual_fps, (width, height))
                 start_time_ms = int(time.time() * 1000)
                 frame_count = 0
-                frame_timestamps = []
+                frame_timestamps = TimestampLog()
+                write_queue = queue.Queue(QUEUE_LEN)
+                writer_stats = WriterStats()
+                writer_thread = threading.Thread(target=video_writer_worker,
+                                                 args=(write_queue, video_writer, frame_timestamps, writer_stats),
+                                                 daemon=True)
+                writer_thread.start()
                 print(f"Recording started at {start_time_ms} ms")
                 
                 # Save first frame
@@ -97,9 +215,9 @@ def main():
                 cv2.imwrite(start_frame_path, image)
             
             if recording:
-                video_writer.write(image)
+                writer_stats.skipped += grabResult.GetNumberOfSkippedImages()
                 current_time_ms = int(time.time() * 1000)
-                frame_timestamps.append((frame_count, current_time_ms))
+                put_drop_oldest(write_queue, (frame_count, current_time_ms, image), writer_stats)
                 frame_count += 1
             
             if key == ord('q'):
@@ -108,8 +226,10 @@ def main():
                     end_frame_path = os.path.join(output_folder, "end_frame.png")
                     cv2.imwrite(end_frame_path, image)
                     end_time_ms = int(time.time() * 1000)
+                    stop_writer(write_queue, writer_thread)  # let the writer drain and finish
                     print(f"Recording ended at {end_time_ms} ms")
-                    print(f"Total frames captured: {frame_count}")
+                    print(f"Total frames captured: {frame_count}, written: {len(frame_timestamps)}")
+                    print(f"Writer: {writer_stats.summary()}")
                     
                     # Save metadata
                     metadata = {
@@ -119,16 +239,18 @@ def main():
                         "actual_fps": actual_fps,
                         "frame_width": width,
                         "frame_height": height,
-                        "total_frames": frame_count,
-                        "frame_timestamps": frame_timestamps,
-                        "video_file": "output.avi",
+                        "total_frames": len(frame_timestamps),
+                        "timestamps_file": "timestamps.npz",  # arrays idx (frame index), ts (time ms)
+                        "video_file": os.path.basename(video_filename),
+                        "video_codec": video_codec or "XVID",
                         "start_frame": "start_frame.png",
                         "end_frame": "end_frame.png"
                     }
                     
+                    frame_timestamps.save(os.path.join(output_folder, "timestamps.npz"))
                     metadata_filename = os.path.join(output_folder, "metadata.json")
-                    with open(metadata_filename, 'w') as f:
-                        json.dump(metadata, f, indent=4)
+                    with open(metadata_filename, 'wb') as f:
+                        f.write(orjson.dumps(metadata, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
                     print(f"Metadata saved to {metadata_filename}")
                 break
             
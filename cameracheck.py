@@ -1,7 +1,13 @@
+import os
 import cv2
 
+cv2.setUseOptimized(True)
+cv2.ocl.setUseOpenCL(True)
+cv2.setNumThreads(max(1, (os.cpu_count() or 2) // 2))
+
 # Try opening the first available camera (usually index 0)
 cap = cv2.VideoCapture(0)
+cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)  # show the newest frame, not a queued one
 
 if not cap.isOpened():
     print("Failed to open camera with OpenCV (index 0)")
@@ -17,7 +23,8 @@ else:
 
         cv2.imshow("OpenCV Camera Test", frame)
 
-        if cv2.waitKey(1) & 0xFF == ord('q'):
+        # non-blocking key check (OpenCV >= 4.5), unlike waitKey(1)
+        if cv2.pollKey() & 0xFF == ord('q'):
             break
 
     cap.release()
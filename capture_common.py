@@ -0,0 +1,125 @@
+"""Helpers shared by the Basler capture scripts."""
+import os, time, datetime, queue, cv2
+import numpy as np
+from pypylon import pylon, genicam
+
+FONT     = cv2.FONT_HERSHEY_SIMPLEX
+TEXT_ORG = (20, 40)
+PREVIEW_MAX_WIDTH = 1280     # wider frames are shrunk for display only
+
+
+def configure_opencv():
+    """Enable OpenCV's optimized/OpenCL paths and use half the cores to avoid oversubscription."""
+    cv2.setUseOptimized(True)
+    cv2.ocl.setUseOpenCL(True)
+    cv2.setNumThreads(max(1, (os.cpu_count() or 2) // 2))
+
+
+def open_triggered_cam(selector="FrameStart", line="Line1", activation="RisingEdge"):
+    """Open the first camera, armed on a hardware trigger."""
+    cam = pylon.InstantCamera(pylon.TlFactory.GetInstance().CreateFirstDevice())
+    cam.Open()
+    nm = cam.GetNodeMap()
+    nm.GetNode("TriggerSelector").SetValue(selector)
+    nm.GetNode("TriggerMode").SetValue("On")
+    nm.GetNode("TriggerSource").SetValue(line)
+    nm.GetNode("TriggerActivation").SetValue(activation)
+    try:
+        nm.GetNode("AcquisitionFrameRateEnable").SetValue(False)
+    except genicam.GenericException:
+        pass
+    return cam
+
+
+def make_run_dir(root="output"):
+    """Create and return root/YYYYmmdd_HHMMSS."""
+    stamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    out_dir = os.path.join(root, stamp)
+    os.makedirs(out_dir, exist_ok=True)
+    return out_dir
+
+
+class WriterStats:
+    """Counters for a grab -> writer queue.
+
+    enqueued/dropped/skipped/max_depth are bumped by the grab thread, the write
+    latency EWMA by the writer thread, so no lock is needed. `skipped` counts
+    frames pylon discarded before the app saw them (GetNumberOfSkippedImages),
+    `dropped` those evicted from the app's own queue or pool.
+    """
+
+    def __init__(self):
+        self.enqueued = 0
+        self.dropped = 0
+        self.skipped = 0
+        self.max_depth = 0           # queue high-water mark, for tuning QUEUE_LEN
+        self.write_ewma_ns = None    # seeded with the first sample
+
+    def note_enqueued(self, q: queue.Queue):
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, q.qsize())
+
+    def record_write(self, t0_ns):
+        """Fold the time since t0_ns (a time.monotonic_ns() value) into the EWMA."""
+        sample = time.monotonic_ns() - t0_ns
+        if self.write_ewma_ns is None:
+            self.write_ewma_ns = float(sample)
+        else:
+            self.write_ewma_ns = 0.9 * self.write_ewma_ns + 0.1 * sample
+
+    def summary(self):
+        lat_us = (self.write_ewma_ns or 0.0) / 1000
+        return (f"enq={self.enqueued} drop={self.dropped} skip={self.skipped} q_max={self.max_depth} "
+                f"lat_us={lat_us:.1f}")
+
+
+def put_drop_oldest(q: queue.Queue, item, stats=None):
+    """Non-blocking put; if the queue is full, discard the oldest entry."""
+    while True:
+        try:
+            q.put_nowait(item)
+            if stats is not None:
+                stats.note_enqueued(q)
+            return
+        except queue.Full:
+            try:
+                q.get_nowait()
+                q.task_done()
+                if stats is not None:
+                    stats.dropped += 1
+            except queue.Empty:
+                pass
+
+
+def stop_writer(q: queue.Queue, thread, timeout=0.5):
+    """Queue the None sentinel behind every pending frame, then join the writer.
+
+    Blocks while the writer drains; gives up only if the writer thread has died.
+    """
+    while thread.is_alive():
+        try:
+            q.put(None, timeout=timeout)
+            break
+        except queue.Full:
+            pass
+    thread.join()
+
+
+def shrink_for_preview(image):
+    """Downscale frames wider than PREVIEW_MAX_WIDTH; smaller ones are returned as-is."""
+    if image.shape[1] <= PREVIEW_MAX_WIDTH:
+        return image
+    scale = PREVIEW_MAX_WIDTH / image.shape[1]
+    return cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+
+def draw_overlay(frame, text, color, buf=None):
+    """Copy frame into buf (allocated if missing) and draw text on it; returns buf.
+
+    imshow copies internally, so callers only need this while an overlay is shown.
+    """
+    if buf is None or buf.shape != frame.shape:
+        buf = np.empty_like(frame)
+    np.copyto(buf, frame)
+    cv2.putText(buf, text, TEXT_ORG, FONT, 1.0, color, 2, cv2.LINE_AA)
+    return buf
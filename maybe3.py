@@ -1,114 +1,202 @@
-import os, time, datetime, csv, threading, queue, cv2
+import os, time, datetime, csv, threading, queue, collections, cv2
+import numpy as np
+import tifffile
 from pypylon import pylon, genicam
+from capture_common import (configure_opencv, open_triggered_cam, make_run_dir,
+                            stop_writer, draw_overlay, shrink_for_preview, WriterStats)
 
 # ---------- tweakables ----------
-QUEUE_LEN        = 200            # frames buffered
+QUEUE_LEN        = 200            # frames buffered (= preallocated frame slots)
 WINDOW_MS        = 12_000         # rotate files every 12 seconds
 PULSE_WINDOW_MS  = 500            # green overlay time
+CSV_BATCH        = 128            # CSV rows formatted per writerows() call
+CSV_BUFFER       = 1 << 20        # CSV file buffer (bytes)
 # --------------------------------
+PULSE_WINDOW_NS  = PULSE_WINDOW_MS * 1_000_000
+
+def take_slot(q: queue.Queue, free: collections.deque, stats: WriterStats) -> int:
+    """Pop a free pool slot; if none is left, drop the oldest queued frame."""
+    while not free:
+        try:
+            _, _, old = q.get_nowait()
+        except queue.Empty:          # writer is about to hand a slot back
+            time.sleep(0.0005)
+            continue
+        free.append(old)
+        q.task_done()
+        stats.dropped += 1
+    return free.popleft()
+
 
-def writer_worker(q: queue.Queue, out_dir: str):
-    """Thread: save images + append rows to a CSV that rotates every 12s."""
+def writer_worker(q: queue.Queue, out_dir: str, pool: list, free: collections.deque,
+                  stats: WriterStats):
+    """Thread: append images to one TIFF stack + CSV index per 12s window.
+
+    Write errors are logged and the frame skipped; its pool slot always goes
+    back on `free`, so a failing disk never starves the grab loop of slots.
+    """
     window_start = None
+    tif, page = None, 0              # open stack and next page index in it
     csv_fh, writer = None, None
-    img_dir = None                   # image subfolder for this window
+    stack_name = None
+    rows = []                        # CSV rows not yet handed to the writer
+
+    def flush_rows():
+        # push each batch to the OS so a crash loses at most CSV_BATCH rows
+        writer.writerows(rows)
+        csv_fh.flush()
+        rows.clear()
+
+    def close_window():
+        # one TIFF close + one CSV close per window instead of per-frame files
+        nonlocal tif, csv_fh
+        if tif is None:
+            return
+        try:
+            tif.close()
+            flush_rows()
+        finally:
+            rows.clear()
+            fh, tif, csv_fh = csv_fh, None, None
+            if fh is not None:
+                fh.close()
+        print(f"[writer] {stack_name}  {stats.summary()}")
 
     def open_new_window(ts_ms: float):
-        nonlocal csv_fh, writer, img_dir, window_start
-        if csv_fh:
-            csv_fh.flush(); csv_fh.close()
-
-        # human‑readable name:  HHMMSS_mmm  (mmm = ms)
-        ts_tag = datetime.datetime.fromtimestamp(ts_ms/1000.0)\
-                                   .strftime("%H%M%S_%f")[:-3]
-        img_dir = os.path.join(out_dir, f"burst_{ts_tag}")
-        os.makedirs(img_dir, exist_ok=True)
-
-        csv_path = os.path.join(out_dir, f"burst_{ts_tag}.csv")
-        csv_fh   = open(csv_path, "w", newline="")
-        writer   = csv.writer(csv_fh)
-        writer.writerow(["frame_id", "timestamp_ms", "filename"])
+        nonlocal tif, page, csv_fh, writer, stack_name, window_start
+        close_window()
+
+        # human‑readable name from host wall clock:  HHMMSS_mmm  (mmm = ms);
+        # ts_ms is camera time (since its clock reset), useless as a date
+        ts_tag = datetime.datetime.now().strftime("%H%M%S_%f")[:-3]
+        stack_name = f"burst_{ts_tag}.tif"
+        tif        = tifffile.TiffWriter(os.path.join(out_dir, stack_name), bigtiff=True)
+        page       = 0
+        csv_path   = os.path.join(out_dir, f"burst_{ts_tag}.csv")
+        csv_fh     = open(csv_path, "w", newline="", buffering=CSV_BUFFER)
+        writer     = csv.writer(csv_fh)
+        writer.writerow(["frame_id", "timestamp_ms", "filename", "page"])
         window_start = ts_ms
-        return csv_fh, writer, img_dir, window_start
+        return tif, page, csv_fh, writer, stack_name, window_start
 
     # wait for first frame before opening files
     while True:
         item = q.get()
         if item is None:
             break
-        fid, ts_ms, frame = item
-        if window_start is None or (ts_ms - window_start) >= WINDOW_MS:
-            csv_fh, writer, img_dir, window_start = open_new_window(ts_ms)
-
-        fname = f"frame_{fid:06d}.png"
-        cv2.imwrite(os.path.join(img_dir, fname), frame)
-        writer.writerow([fid, f"{ts_ms:.3f}", os.path.join(os.path.basename(img_dir), fname)])
-        q.task_done()
+        fid, ts_ms, slot = item
+        try:
+            # range check, not just >=: a host-time fallback frame may sit in
+            # a different clock domain than the window start
+            if tif is None or not (0 <= ts_ms - window_start < WINDOW_MS):
+                tif, page, csv_fh, writer, stack_name, window_start = open_new_window(ts_ms)
+
+            t0 = time.monotonic_ns()
+            tif.write(pool[slot], contiguous=True)
+            stats.record_write(t0)
+            rows.append((fid, f"{ts_ms:.3f}", stack_name, page))
+            page += 1
+            if len(rows) >= CSV_BATCH:
+                flush_rows()
+        except Exception as e:       # disk full, permissions, ...: skip this frame
+            print(f"[writer] frame {fid} not saved: {e}")
+        finally:
+            free.append(slot)        # slot may be refilled by the grab loop now
+            q.task_done()
 
-    if csv_fh:
-        csv_fh.flush(); csv_fh.close()
+    try:
+        close_window()
+    except Exception as e:
+        print(f"[writer] could not close {stack_name}: {e}")
     print("[writer] done , all images & CSV rows flushed")
 
 
 def main():
+    configure_opencv()
+
     # ---------- camera config ----------
-    cam = pylon.InstantCamera(pylon.TlFactory.GetInstance().CreateFirstDevice())
-    cam.Open()
+    cam = open_triggered_cam("FrameStart", "Line1")     # Arduino pulses
     nm = cam.GetNodeMap()
-    nm.GetNode("TriggerSelector").SetValue("FrameStart")
-    nm.GetNode("TriggerMode").SetValue("On")
-    nm.GetNode("TriggerSource").SetValue("Line1")       # Arduino pulses
-    nm.GetNode("TriggerActivation").SetValue("RisingEdge")
+    # camera-side timestamp chunk: one field read per frame, latched at exposure
+    try:
+        nm.GetNode("ChunkModeActive").SetValue(True)
+        nm.GetNode("ChunkSelector").SetValue("Timestamp")
+        nm.GetNode("ChunkEnable").SetValue(True)
+        chunk_ts = True
+    except (genicam.GenericException, AttributeError):
+        chunk_ts = False
+    # GigE models count ticks of GevTimestampTickFrequency, USB models count ns
     try:
-        nm.GetNode("AcquisitionFrameRateEnable").SetValue(False)
-    except genicam.GenericException:
-        pass
+        tick_ms = 1000.0 / nm.GetNode("GevTimestampTickFrequency").GetValue()
+    except (genicam.GenericException, AttributeError):
+        tick_ms = 1e-6
     cam.StartGrabbing(pylon.GrabStrategy_LatestImageOnly)
     # ------------------------------------
 
     # ---------- output paths ----------
-    stamp   = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    out_dir = os.path.join("output", stamp)
-    os.makedirs(out_dir, exist_ok=True)
+    out_dir = make_run_dir()
 
     q = queue.Queue(QUEUE_LEN)
-    t = threading.Thread(target=writer_worker, args=(q, out_dir), daemon=True)
+    # frame pool shared with the writer: slots travel through the queue by
+    # index and come back on `free` once written, so no per-frame allocation
+    pool, free = [], collections.deque()
+    stats = WriterStats()
+    t = threading.Thread(target=writer_worker, args=(q, out_dir, pool, free, stats), daemon=True)
     t.start()
 
     cv2.namedWindow("Basler Preview", cv2.WINDOW_NORMAL)
-    count, flash_until = 0, 0
+    count, flash_until = 0, 0                         # flash_until in monotonic ns
+    mono = time.monotonic_ns                          # local: one lookup per call
     dummy = None
+    disp_buf = None                                   # overlay scratch, allocated once
 
     try:
         while cam.IsGrabbing():
             grab = cam.RetrieveResult(1000, pylon.TimeoutHandling_Return)
+            if grab:
+                stats.skipped += grab.GetNumberOfSkippedImages()
             if grab and grab.GrabSucceeded():
-                frame = grab.Array
-                # use camera’s own µs timestamp if available
-                try:
-                    ts_ms = grab.TimeStamp / 1000.0
-                except AttributeError:
+                # copy straight out of the pylon buffer into a reused slot
+                # instead of letting grab.Array allocate a new array per frame
+                with grab.GetArrayZeroCopy() as src:
+                    if not pool:
+                        pool.extend(np.empty_like(src) for _ in range(QUEUE_LEN))
+                        free.extend(range(QUEUE_LEN))
+                    slot = take_slot(q, free, stats)
+                    frame = pool[slot]
+                    np.copyto(frame, src)
+                # use camera’s own chunk timestamp if available; a grab
+                # missing the chunk falls back to host time for that frame
+                ts_ms = None
+                if chunk_ts:
+                    try:
+                        ts_ms = grab.ChunkTimestamp.Value * tick_ms
+                    except (genicam.GenericException, AttributeError):
+                        pass
+                if ts_ms is None:
                     ts_ms = time.time()*1000
                 count += 1
-                q.put((count, ts_ms, frame))          # hand off to writer
-                flash_until = time.time()*1000 + PULSE_WINDOW_MS
-                dummy = frame                         # show latest
+                q.put_nowait((count, ts_ms, slot))    # never full: one entry per slot
+                stats.note_enqueued(q)
+                flash_until = mono() + PULSE_WINDOW_NS
+                dummy = shrink_for_preview(frame)     # show latest, display size
+            if grab:
+                grab.Release()                        # hand buffer back to pylon
 
             # ---- UI update, even if no new frame ----
             if dummy is not None:
-                disp = dummy.copy()
-                if time.time()*1000 < flash_until:
-                    cv2.putText(disp, f"#{count}", (20, 40),
-                                cv2.FONT_HERSHEY_SIMPLEX, 1, (0,255,0), 2)
-                cv2.imshow("Basler Preview", disp)
+                if mono() < flash_until:
+                    disp_buf = draw_overlay(dummy, f"#{count}", (0,255,0), disp_buf)
+                    cv2.imshow("Basler Preview", disp_buf)
+                else:
+                    cv2.imshow("Basler Preview", dummy)
 
-            if cv2.waitKey(1) & 0xFF == ord('q'):
+            if cv2.pollKey() & 0xFF == ord('q'):
                 break
 
     finally:
         cam.StopGrabbing();  cam.Close()
-        q.put(None)        # tell writer to finish
-        t.join()
+        stop_writer(q, t)  # tell writer to finish; no hang if it died
         cv2.destroyAllWindows()
         print(f"[main] finished , {count} frames captured to {out_dir}")
 